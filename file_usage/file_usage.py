@@ -1,19 +1,39 @@
-from __future__ import print_function
 import sys
-from collections import defaultdict, namedtuple
-import os.path
-from argparse import ArgumentParser
-from termcolor import colored, cprint
+import os
+import gc
+from argparse import ArgumentParser, ArgumentTypeError
+from itertools import islice
+from functools import lru_cache, partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from types import MappingProxyType
+from termcolor import colored
 import operator 
 
 DEFAULT_PERCENT_THRESHOLD = 1.0 
 DEFAULT_SHOW_USERS = False
 DEFAULT_INDENT = 8
 DEFAULT_PRECISION = 1
+DEFAULT_JOBS = 1
 USER_NAME_COLOR = 'red'
 FILE_SIZE_COLOR = 'yellow'
 FILE_COUNT_COLOR = 'yellow'
 FILE_PATH_COLOR = 'blue'
+# Number of bytes of input to read at a time
+INPUT_BLOCK_SIZE = 1 << 20
+# Maximum number of lines of output to collect before writing them
+OUTPUT_BLOCK_LINES = 10000
+
+def positive_int(value_str):
+    '''Parse a command line argument which must be an integer of at least 1.
+    '''
+    try:
+        value = int(value_str)
+    except ValueError:
+        raise ArgumentTypeError("invalid int value: '{}'".format(value_str))
+    if value < 1:
+        raise ArgumentTypeError("must be at least 1: '{}'".format(value_str))
+    return value
 
 def parse_args():
     '''Parse command line arguments.
@@ -55,6 +75,13 @@ def parse_args():
     parser.add_argument('--showusers', action='store_true',
         default=DEFAULT_SHOW_USERS,
         help='Show usernames associated with files/directories in the output')
+    parser.add_argument(
+        '--jobs',
+        metavar='N',
+        type=positive_int,
+        default=DEFAULT_JOBS,
+        help='Number of processes used to parse the input (default {})'.format(
+            DEFAULT_JOBS))
     return parser.parse_args()
 
 
@@ -66,10 +93,21 @@ UNITS_IN_BYTES = {
     "T": 1024 ** 4 
 }
 
-# from: https://www.safaribooksonline.com/library/view/python-cookbook/0596001673/ch04s16.html
+# Map from size designator, in either case, to its multiplier in bytes
+DESIGNATOR_MULTIPLIERS = dict(
+    [(units, bytes) for (units, bytes) in UNITS_IN_BYTES.items()] +
+    [(units.lower(), bytes) for (units, bytes) in UNITS_IN_BYTES.items()])
+
+# Multiplying by this is exact, because a gigabyte is a power of two bytes
+GB_PER_BYTE = 1.0 / UNITS_IN_BYTES["G"]
+
 def splitall(path):
     '''Split a file path into a list of components.
 
+    A leading run of slashes is kept as a single component naming the
+    root, in the same way as os.path.split, and empty components are
+    dropped. Components are interned.
+
     >>> splitall("/hsm/VR0182/shared/Data")
     ['/', 'hsm', 'VR0182', 'shared', 'Data']
     >>> splitall("")
@@ -82,19 +120,12 @@ def splitall(path):
     ['/', 'foo', 'bar']
 
     '''
-    allparts = []
-    while 1:
-        parts = os.path.split(path)
-        if parts[0] == path:  # sentinel for absolute paths
-            allparts.insert(0, parts[0])
-            break
-        elif parts[1] == path: # sentinel for relative paths
-            allparts.insert(0, parts[1])
-            break
-        else:
-            path = parts[0]
-            allparts.insert(0, parts[1])
-    return allparts
+    rest = path.lstrip('/')
+    root = path[:len(path) - len(rest)]
+    allparts = [sys.intern(part) for part in rest.split('/') if part]
+    if root:
+        allparts.insert(0, sys.intern(root))
+    return allparts or [path]
 
 def size_in_bytes(size_str):
     '''Compute how many bytes are used in by a file
@@ -113,7 +144,9 @@ def size_in_bytes(size_str):
     T = terabytes
 
     If the designator is not given then we assume it was "B"
-    for bytes.
+    for bytes. Designators may be given in upper or lower case.
+
+    Raises ValueError if the size cannot be parsed.
 
     >>> size_in_bytes('45')
     45.0
@@ -121,30 +154,45 @@ def size_in_bytes(size_str):
     42.0
     >>> size_in_bytes('12M')
     12582912.0
+    >>> size_in_bytes('12m')
+    12582912.0
     >>> size_in_bytes('100G')
     107374182400.0
     >>> size_in_bytes('100T')
     109951162777600.0
     >>> size_in_bytes('1T')
     1099511627776.0
+    >>> size_in_bytes('45B')
+    45.0
 
     '''
-    if len(size_str) >= 1:
-        units = size_str[-1]
-        if units.upper() not in ["K", "M", "G", "T"]:
-            units = "B"
-            number = size_str
-        else:
-            number = size_str[:-1]
-        try:
-            scalar = float(number)
-        except:
-            pass
-        else:
-            return scalar * UNITS_IN_BYTES[units]
-    # If we get here then there was something wrong with
-    # the input file size
-    exit("Bad file size in input: '{}'".format(size_str))
+    multiplier = DESIGNATOR_MULTIPLIERS.get(size_str[-1:])
+    if multiplier is None:
+        return float(size_str)
+    return float(size_str[:-1]) * multiplier
+
+@lru_cache(maxsize=None)
+def color_format(color):
+    '''Make a function which colors its argument in the same way as
+    termcolor.colored(text, color).
+
+    termcolor builds the escape sequences from scratch on every call.
+    Here the text is substituted into a template which termcolor
+    made once for each color, so it still respects ANSI_COLORS_DISABLED.
+    '''
+    return colored('{}', color).format
+
+@lru_cache(maxsize=None)
+def gb_renderer(precision):
+    '''Make a function which renders a number of bytes as a string, in
+    gigabytes units, showing precision number of decimal places.
+
+    The format string is only built once for each precision.
+    '''
+    format_gb = '{{:.{}f}}'.format(precision).format
+    def render_gb(bytes):
+        return format_gb(bytes * GB_PER_BYTE)
+    return render_gb
 
 def render_bytes_in_gb(bytes, precision):
     '''Render a number of bytes as a string, in gigabytes units, showing
@@ -154,8 +202,7 @@ def render_bytes_in_gb(bytes, precision):
     '4.657'
 
     '''
-    format_str = '{{:.{}f}}'.format(precision)
-    return format_str.format(float(bytes) / UNITS_IN_BYTES["G"])
+    return gb_renderer(precision)(bytes)
 
 class User(object):
     '''User information for a single node in the file tree (a file or a directory).
@@ -178,37 +225,212 @@ class User(object):
     def size(self):
         return self.file_size
 
-    def render(self, precision=DEFAULT_PRECISION):
+    def render(self, precision=DEFAULT_PRECISION, name_str=None):
+        '''Render the user information as a string.
+
+        name_str is the colored user name, for callers which render the
+        same user many times and have already colored it.
+        '''
+        if name_str is None:
+            name_str = color_format(USER_NAME_COLOR)(self.name)
         size_str = render_bytes_in_gb(self.file_size, precision)
         text = "{}: size = {}, count = {}".format(
-            colored(self.name, USER_NAME_COLOR),
-            colored(size_str, FILE_SIZE_COLOR),
-            colored(self.count, FILE_COUNT_COLOR))
+            name_str,
+            color_format(FILE_SIZE_COLOR)(size_str),
+            color_format(FILE_COUNT_COLOR)(self.count))
         return text 
 
 
+# Nodes with more users than this find them through a dictionary, instead
+# of scanning the list of user ids, see Node.user_index
+MAX_SCANNED_USERS = 8
+
+# The children of every node which doesn't have any. It is read-only, so
+# that it can't be added to by accident, see Node.writable_children.
+NO_CHILDREN = MappingProxyType({})
+
 class Node(object):
     '''A node in the file tree.
     Regular files and empty directories will have zero children.
 
     Non-empty directories will have one entry in children for each child.
 
-    Each node
+    The per-user information for the node is kept in three parallel lists,
+    indexed in the same way, rather than as a User object per user. There
+    is a node for every file and directory in the input, so this saves a lot
+    of memory. Users are identified by their index in FilePathTree.user_names.
+    Most nodes have only one or two users, so finding a user is a quick scan
+    of user_ids, but the nodes near the top of the tree may have thousands,
+    so nodes with more than MAX_SCANNED_USERS also keep a user_index.
+
+    For the same reason nodes have fixed __slots__ instead of an attribute
+    dictionary, and nodes without children all share NO_CHILDREN (most
+    nodes are regular files) until a child is added.
     '''
-    def __init__(self):
+    __slots__ = ('children', 'user_ids', 'user_sizes', 'user_counts', 'user_index',
+        'file_size', 'collapsed')
+
+    def __init__(self, user_id=None, size_bytes=0.0):
+        '''Make a node, which is empty unless user_id is given, in which
+        case it has one file of size_bytes owned by user_id (the same as
+        calling add afterwards, only cheaper).
+        '''
         # Map from path entry to Node
-        self.children = {} 
-        # Map from user_name to User info
-        self.users = {}
+        self.children = NO_CHILDREN
+        # The ids of the users who own files/directories in this node, and
+        # the transitive size and count of the files/directories owned by
+        # each of them. These start out as the (shared) empty tuple and become
+        # lists when the first user is added, so that we don't allocate
+        # empty lists only to throw them away.
+        if user_id is None:
+            self.user_ids = ()
+            self.user_sizes = ()
+            self.user_counts = ()
+        else:
+            self.user_ids = [user_id]
+            self.user_sizes = [size_bytes]
+            self.user_counts = [1]
+        # Map from user id to its index in user_ids, or None if there are
+        # few enough users to scan user_ids instead
+        self.user_index = None
+        # Sum of the sizes of all the files/directories owned by all users
+        # in this node, maintained incrementally by FilePathTree
+        self.file_size = size_bytes
+        # If this node has just one child, which itself may have just one
+        # child and so on, then this is the pair (names, bottom), where
+        # names are the path entries of that chain of children, from the
+        # bottom up, and bottom is the last node in the chain. Set by
+        # collapse.
+        self.collapsed = None
 
     def size(self):
         '''The size of a node in the tree is equal to the sum of the sizes
         of all the files/directories owned by all users in this node.
 
-        We compute it this way because size is associated with a user (the owner
-        of the file).
+        The sum is accumulated as the tree is built, so we don't have to
+        recompute it over all the users every time the node is sorted or
+        displayed.
+        '''
+        return self.file_size
+
+    def writable_children(self):
+        '''The children of this node, as a dictionary which new children can
+        be added to.
+        '''
+        if self.children is NO_CHILDREN:
+            self.children = {}
+        return self.children
+
+    def add(self, user_id, size_bytes):
+        '''Add a file of size_bytes owned by user_id to this node.
+        '''
+        if self.user_ids:
+            self.add_user(user_id, size_bytes, 1)
+        else:
+            self.user_ids = [user_id]
+            self.user_sizes = [size_bytes]
+            self.user_counts = [1]
+        self.file_size += size_bytes
+
+    def merge(self, node):
+        '''Add the sizes and counts of all the users of node to this node.
+        '''
+        user_ids = self.user_ids
+        if user_ids:
+            user_sizes = self.user_sizes
+            user_counts = self.user_counts
+            for user_id, file_size, count in zip(node.user_ids, node.user_sizes, node.user_counts):
+                # The same as add_user, but without a method call for the
+                # common case of a user the node already has
+                user_index = self.user_index
+                if user_index is not None:
+                    index = user_index.get(user_id)
+                elif user_id in user_ids:
+                    index = user_ids.index(user_id)
+                else:
+                    index = None
+                if index is None:
+                    self.add_user(user_id, file_size, count)
+                else:
+                    user_sizes[index] += file_size
+                    user_counts[index] += count
+        else:
+            self.user_ids = list(node.user_ids)
+            self.user_sizes = list(node.user_sizes)
+            self.user_counts = list(node.user_counts)
+            if node.user_index is not None:
+                self.user_index = dict(node.user_index)
+        self.file_size += node.file_size
+
+    def add_user(self, user_id, file_size, count):
+        '''Add file_size and count to the totals of user_id in this node,
+        which already has at least one user. This does not update
+        file_size, see add and merge.
         '''
-        return sum([user_stats.size() for (user_name, user_stats) in self.users.items()])
+        user_ids = self.user_ids
+        user_index = self.user_index
+        if user_index is not None:
+            index = user_index.get(user_id)
+        elif user_id in user_ids:
+            index = user_ids.index(user_id)
+        else:
+            index = None
+        if index is None:
+            if user_index is not None:
+                user_index[user_id] = len(user_ids)
+            user_ids.append(user_id)
+            self.user_sizes.append(file_size)
+            self.user_counts.append(count)
+            if user_index is None and len(user_ids) > MAX_SCANNED_USERS:
+                self.user_index = {user_id: index for index, user_id in enumerate(user_ids)}
+        else:
+            self.user_sizes[index] += file_size
+            self.user_counts[index] += count
+
+    def collapse(self):
+        '''If this node has just one child, record the chain of single
+        children below it in collapsed. Call this after collapse has been
+        called on the child.
+
+        The chain of the child is taken over by this node, so that long
+        sticks are collapsed in linear time.
+
+        >>> tree = FilePathTree()
+        >>> tree.insert('/x/y/z/f', 1.0, 'bob')
+        >>> tree.insert('/x/y/z/g', 2.0, 'bob')
+        >>> tree.accumulate()
+        >>> names, bottom = tree.tree['/'].collapsed
+        >>> list(reversed(names))
+        ['x', 'y', 'z']
+        >>> sorted(bottom.children)
+        ['f', 'g']
+        >>> tree.tree['/'].children['x'].collapsed is None
+        True
+
+        '''
+        if len(self.children) == 1:
+            child_name, child = next(iter(self.children.items()))
+            if child.collapsed is None:
+                self.collapsed = ([child_name], child)
+            else:
+                names, bottom = child.collapsed
+                names.append(child_name)
+                self.collapsed = (names, bottom)
+                child.collapsed = None
+
+    def users(self, user_names):
+        '''Compute a dictionary mapping user_name to User info for this node,
+        where user_names maps user ids to user names.
+
+        The users are in order of their ids, which is the order they first
+        appear in the input, so that users of the same size are always
+        displayed in the same order.
+        '''
+        users = {}
+        for user_id, file_size, count in sorted(zip(self.user_ids, self.user_sizes, self.user_counts)):
+            user_name = user_names[user_id]
+            users[user_name] = User(user_name, file_size, count)
+        return users
 
 class FilePathTree(object):
     '''An entire tree for a set of file paths from the same file system.
@@ -216,29 +438,175 @@ class FilePathTree(object):
     The tree itself is a dictionary that maps file/directory names to nodes.
 
     Nodes are themselves trees.
+
+    Building the tree is done in two steps, to keep the work done for each
+    inserted path (each line of input) to a minimum:
+
+    1. insert records the size and user of each path in the node for the
+       path alone. Many files share the same directory, so the children of
+       each directory are cached the first time the directory is seen, and
+       later inserts into the same directory don't split the path or walk
+       down the tree one component at a time.
+
+    2. accumulate then adds the sizes and users of every node into its
+       parent, from the bottom of the tree up, so that each node has the
+       transitive size and count of everything underneath it. This is done
+       once per node, rather than once for each ancestor of every path.
+       At the same time, chains of directories which contain just one file
+       are collapsed (see Node.collapse), for the display.
     '''
     def __init__(self):
         self.tree = {}
+        # Map from user_name to user id, and from user id back to user_name
+        self.user_ids = {}
+        self.user_names = []
+        # Map from directory path (including its trailing slash) to the
+        # children of the directory's node
+        self.dir_children = {'': self.tree}
+        # True once accumulate has been called
+        self.accumulated = False
 
     def insert(self, path_str, size_bytes, user_name):
-        path_list = splitall(path_str)
+        '''Insert a file/directory of size_bytes owned by user_name.
+
+        The size of the ancestors of the path is not updated until
+        accumulate is called, so all the paths must be inserted before then.
+        Raises RuntimeError if accumulate has already been called.
+        '''
+        self.insert_bulk((path_str,), (size_bytes,), (user_name,))
+
+    def insert_bulk(self, paths, sizes, user_names):
+        '''Insert many files/directories at once, given as parallel
+        columns of paths, sizes in bytes and owning user names.
+
+        This is the same as calling insert for each path, but without the
+        overhead of a method call and attribute lookups for each one.
+        '''
+        if self.accumulated:
+            raise RuntimeError("Cannot insert into a FilePathTree after accumulate")
+        user_ids = self.user_ids
+        all_user_names = self.user_names
+        dir_children = self.dir_children
+        intern = sys.intern
+        for path_str, size_bytes, user_name in zip(paths, sizes, user_names):
+            user_id = user_ids.get(user_name)
+            if user_id is None:
+                user_id = len(all_user_names)
+                user_ids[user_name] = user_id
+                all_user_names.append(user_name)
+            split_pos = path_str.rfind('/') + 1
+            file_name = path_str[split_pos:]
+            # file_name is empty if path_str ends in a slash, which is rare
+            if file_name:
+                dir_str = path_str[:split_pos]
+                children = dir_children.get(dir_str)
+                if children is None:
+                    nodes = self.find_nodes(dir_str)
+                    children = nodes[-1].writable_children() if nodes else self.tree
+                    dir_children[dir_str] = children
+                file_name = intern(file_name)
+                # Most paths are new files, so create their node
+                # with its user up front
+                this_node = children.get(file_name)
+                if this_node is None:
+                    children[file_name] = Node(user_id, size_bytes)
+                else:
+                    this_node.add(user_id, size_bytes)
+            else:
+                nodes = self.find_nodes(path_str)
+                if nodes:
+                    nodes[-1].add(user_id, size_bytes)
+
+    def find_nodes(self, path_str):
+        '''Compute the list of nodes along path_str, from the top of the
+        tree down, creating any nodes which are not already in the tree.
+        '''
+        nodes = []
         tree = self.tree
-        for item in path_list:
-            if len(item.strip()) > 0:
-                if item not in tree:
-                    this_node = Node()
-                    tree[item] = this_node
-                    this_node.users = { user_name : User(user_name, size_bytes, 1) } 
+        for item in splitall(path_str):
+            if item:
+                this_node = tree.get(item)
+                if this_node is None:
+                    this_node = tree[item] = Node()
+                nodes.append(this_node)
+                tree = this_node.writable_children()
+        return nodes
+
+    def accumulate(self):
+        '''Add the size and users of every node into its parent, from the
+        bottom of the tree up, and collapse the nodes with just one child.
+        Call this after all the paths have been inserted. Calling it again
+        does nothing, rather than adding every size in twice, and inserting
+        any more paths is an error.
+
+        The tree is traversed with an explicit stack, so deeply nested paths
+        can't exceed the recursion limit.
+
+        >>> tree = FilePathTree()
+        >>> tree.insert('/a/b/f', 1024.0, 'bob')
+        >>> tree.insert('/a/g', 2048.0, 'alice')
+        >>> tree.insert('/a/', 512.0, 'bob')
+        >>> tree.insert('/', 1.0, 'carol')
+        >>> tree.accumulate()
+        >>> root = tree.tree['/']
+        >>> root.size(), root.children['a'].size(), root.children['a'].children['b'].size()
+        (3585.0, 3584.0, 1024.0)
+        >>> [(user.name, user.file_size, user.count) for user in root.users(tree.user_names).values()]
+        [('bob', 1536.0, 2), ('alice', 2048.0, 1), ('carol', 1.0, 1)]
+        >>> tree.accumulate()
+        >>> root.size()
+        3585.0
+        >>> tree.insert('/a/h', 1.0, 'bob')
+        Traceback (most recent call last):
+        ...
+        RuntimeError: Cannot insert into a FilePathTree after accumulate
+
+        '''
+        if self.accumulated:
+            return
+        self.accumulated = True
+        for top_node in self.tree.values():
+            # Stack of the nodes on the path down to the current node, each
+            # with an iterator over its children which are still to be visited
+            stack = [(top_node, iter(top_node.children.values()))]
+            while stack:
+                node, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    # All the children of node have been added into it
+                    stack.pop()
+                    if stack:
+                        stack[-1][0].merge(node)
+                    node.collapse()
+                elif child.children is NO_CHILDREN:
+                    # Most nodes are regular files, which can be added
+                    # straight away without going on the stack
+                    node.merge(child)
                 else:
-                    this_node = tree[item]
-                    this_users = this_node.users
-                    if user_name in this_users:
-                        this_user = this_users[user_name]
-                        this_user.file_size += size_bytes
-                        this_user.count += 1
-                    else:
-                        this_users[user_name] = User(user_name, size_bytes, 1)
-                tree = this_node.children
+                    stack.append((child, iter(child.children.values())))
+
+    def user_totals(self):
+        '''Compute a summary of each user's usage over the whole tree.
+
+        Every inserted path passes through exactly one top level node of
+        the tree, so the users of the top level nodes already account
+        for every file. Merging them here saves updating a separate
+        summary for every line of the input.
+
+        Returns a dictionary mapping user_name to User info. Call this after
+        accumulate.
+        '''
+        user_names = self.user_names
+        sizes = [0.0] * len(user_names)
+        counts = [0] * len(user_names)
+        for top_node in self.tree.values():
+            for user_id, file_size, count in zip(top_node.user_ids, top_node.user_sizes, top_node.user_counts):
+                sizes[user_id] += file_size
+                counts[user_id] += count
+        # In order of user id, which is the order the users first appear in
+        # the input, as for Node.users
+        return {user_name: User(user_name, file_size, count)
+                    for user_name, file_size, count in zip(user_names, sizes, counts)}
 
 
 class FilePathTreeRender(object):
@@ -255,120 +623,286 @@ class FilePathTreeRender(object):
         self.precision = precision
         self.total_size = total_size
         self.percent_threshold = percent_threshold
+        # Files/directories and users are only displayed if their size is at
+        # least percent_threshold percent of the total size for the whole set
+        # of considered file paths. Converting the threshold to a number of
+        # bytes once up front means the check is a single comparison.
+        self.min_size = total_size * percent_threshold / 100.0
+        # Same as render_bytes_in_gb, for our precision
+        self.render_gb = gb_renderer(precision)
+        self.path_format = color_format(FILE_PATH_COLOR)
+        # Map from user_name to the colored user name, filled in as the
+        # users are displayed, because the same few users are typically
+        # displayed for many nodes
+        self.user_name_strs = {}
+        # The indentation for each depth in the tree, filled in as needed
+        self.indent_strs = []
 
     def render(self):
-        self.render_rec(self.file_path_tree.tree, 0)
+        '''Write the tree to stdout, showing each file/directory which is big
+        enough, followed by its contents, largest first.
 
-    def render_rec(self, tree, current_depth):
-        if len(tree) == 0:
-            # reached a leaf of the tree, nothing to print
-            return
+        The tree is traversed with an explicit stack, so deeply nested paths
+        can't exceed the recursion limit.
+        '''
+        # The output lines are collected and written in blocks, rather than
+        # printing each line separately
+        lines = []
+        # Only display and traverse nodes which are big enough. Usually most
+        # children are too small, so they are left out before the rest are
+        # sorted by their size.
+        min_size = self.min_size
+        path_format = self.path_format
+        render_gb = self.render_gb
+        precision = self.precision
+        show_users = self.show_users
+        user_names = self.file_path_tree.user_names
+        user_name_str = self.user_name_str
+        add_line = lines.append
+        # Stack of the iterators over the (sorted) children which are still
+        # to be displayed at each depth, with the indentation for that depth
+        stack = [(iter(iter_by_size(self.file_path_tree.tree, min_size)), '')]
+        while stack:
+            items, indent = stack[-1]
+            item = next(items, None)
+            if item is None:
+                stack.pop()
+                continue
+            path, node, node_size = item
+
+            # Directories which contain just one file are collapsed into one
+            # line. This helps avoid gratuitous nesting in the output,
+            # especially for paths which are sticks.
+            if node.collapsed is not None:
+                names, node = node.collapsed
+                # Don't insert a forward slash if we are at the root
+                # directory, because it is already called /
+                if path != '/':
+                    path += '/'
+                path += '/'.join(reversed(names))
+
+            add_line("{}{} ({} GB)".format(indent, path_format(path),
+                render_gb(node_size)))
+
+            if show_users:
+                # Show user information for this node, for those users whose
+                # used file size is big enough.
+                # Sort the users by the size of their contribution
+                for user, user_stats, user_size in iter_by_size(node.users(user_names), min_size): 
+                    add_line("{}  - {}".format(indent,
+                        user_stats.render(precision, user_name_str(user))))
+
+            # Bound the memory used for the output of very large trees
+            if len(lines) >= OUTPUT_BLOCK_LINES:
+                write_lines(lines)
+
+            # Display the children of the node next
+            if node.children:
+                stack.append((iter(iter_by_size(node.children, min_size)),
+                    self.indent_str(len(stack))))
+        write_lines(lines)
+
+    def indent_str(self, depth):
+        '''The indentation for output lines for nodes at depth in the tree.
+        '''
+        indent_strs = self.indent_strs
+        while len(indent_strs) <= depth:
+            indent_strs.append(' ' * (self.indent * len(indent_strs)))
+        return indent_strs[depth]
 
-        # Sort the children by their size
-        for path, node, node_size in iter_by_size(tree): 
-            node_size = node.size() 
-            # Only display and traverse nodes which are big enough
-            if self.is_big_enough(node_size):
-
-                # Try to collapse directories which contain just one file.
-                # This helps avoid gratuitous nesting in the output, especially
-                # for paths which are sticks.
-
-                while len(node.children) == 1:
-                    child_path, node = node.children.items()[0]
-                    # Don't insert a forward slash if we are at the root
-                    # directory, because it is already called /
-                    if path == '/':
-                        path += child_path 
-                    else:
-                        path += '/' + child_path 
-
-                # Indent the output based on how deep we are in the tree
-                indent = ' ' * (self.indent * current_depth)
-
-                print("{}{} ({} GB)".format(indent, colored(path, FILE_PATH_COLOR),
-                    render_bytes_in_gb(node_size, self.precision)))
-
-                if self.show_users:
-                    # Show user information for this node
-                    # Sort the users by the size of their contribution
-                    for user, user_stats, user_size in iter_by_size(node.users): 
-                        # Only print user information if their used file size big enough
-                        if self.is_big_enough(user_size):
-                            print("{}  - {}".format(indent, user_stats.render(self.precision)))
-
-                # Recurse into the children of the node
-                self.render_rec(node.children, current_depth + 1)
-
-    def is_big_enough(self, size):
-        '''Compute the percentage this size is of the total size for the whole
-        set of considerd file paths.
-
-        If the percentage is >= to user defined threshold then return True, indicating
-        that the size is big enough to warrant consideration.
+    def user_name_str(self, user_name):
+        '''The colored user name for user_name, computed once per user.
         '''
-        return (size / self.total_size) * 100.0 >= self.percent_threshold 
+        name_str = self.user_name_strs.get(user_name)
+        if name_str is None:
+            name_str = color_format(USER_NAME_COLOR)(user_name)
+            self.user_name_strs[user_name] = name_str
+        return name_str
+
 
+def write_lines(lines):
+    '''Write lines to stdout in one go, and then empty lines.
+    '''
+    if lines:
+        sys.stdout.write('\n'.join(lines))
+        sys.stdout.write('\n')
+        del lines[:]
 
-def iter_by_size(dict):
-    '''Given a dictionary whose values have a .size() method,
-    compute a list of descending sorted triples: (key, val, val.size())
+
+def iter_by_size(dict, min_size=None):
+    '''Given a dictionary whose values have a file_size attribute
+    (Nodes and Users), compute a list of descending sorted triples:
+    (key, val, val.file_size)
 
     We use this repeatedly when displaying various parts of the output because
     it is useful to show items in size sorted order, so that the largest is
     displayed first
+
+    If min_size is given then only items whose size is at least min_size are
+    included. Filtering happens before sorting, which matters for wide
+    directories where most of the items are too small to be displayed.
+
+    Reading file_size directly, rather than calling size(), and sorting
+    with itemgetter keeps per-item Python function calls out of the loop.
     '''
-    items = [(key, val, val.size()) for (key, val) in dict.items()] 
-    return sorted(items, key=operator.itemgetter(2), reverse=True)
+    if min_size is None:
+        items = [(key, val, val.file_size) for (key, val) in dict.items()] 
+    else:
+        items = [(key, val, val.file_size) for (key, val) in dict.items()
+                     if val.file_size >= min_size]
+    items.sort(key=operator.itemgetter(2), reverse=True)
+    return items
+
+
+def input_blocks(input_fd, block_size=INPUT_BLOCK_SIZE):
+    '''Generate the contents of the input file descriptor input_fd as blocks
+    of whole lines, reading up to block_size bytes at a time.
+
+    The terminator of the last line in each block is removed. A line that
+    spans the end of a block is carried over to the next one.
 
+    The blocks are read directly from the file descriptor, because the
+    buffering of a file object would only copy them again.
 
-def consider_file(args, user_name, path):
-    '''Check if we should consider a file for inclusion in the file_path tree.
-    The decision is affected by user supplied command line arguments for:
-        - user_name (only consider files/dirs owned by this user)
-        - path (only consider files/dirs that start with this path prefix)
+    >>> read_fd, write_fd = os.pipe()
+    >>> os.write(write_fd, b'1K bob /a\\n2K alice /b\\n3K')
+    24
+    >>> os.close(write_fd)
+    >>> list(input_blocks(read_fd, block_size=8))
+    [b'1K bob /a', b'2K alice /b', b'3K']
+    >>> os.close(read_fd)
 
-    If one or both of the command line arguments are set, and at least
-    one of the conditions is not met, then we do not consider the file
-    (skip over it).
     '''
-    result = True
-    if args.path and (not (path.startswith(args.path))):
-        result = False
-    if args.user and (not (user_name == args.user)):
-        result = False
-    return result
+    remainder = b''
+    while True:
+        block = os.read(input_fd, block_size)
+        if not block:
+            break
+        block = remainder + block
+        end = block.rfind(b'\n')
+        if end < 0:
+            remainder = block
+        else:
+            remainder = block[end + 1:]
+            yield block[:end]
+    if remainder:
+        yield remainder
+
+
+def parse_block(args, block, encoding, errors):
+    '''Parse a block of input lines into columns of file paths, sizes in
+    bytes and owning user names.
+    Returns (num_skipped_lines, paths, sizes, user_names), where
+    num_skipped_lines is the number of lines which could not be parsed.
+
+    This is much faster than iterating over the lines of a text file because
+    the decoding and splitting are done a block at a time, and the lines are
+    processed a column at a time, so that most of the per-line work is done
+    by builtins (map, zip) looping in C.
+
+    If the user supplied the --user or --path command line arguments, only
+    files/dirs owned by that user, and whose paths start with that prefix,
+    are considered. These filters are applied before the sizes are parsed,
+    so skipped lines cost very little.
+
+    This may be run in a worker process, see parallel_map.
+
+    >>> from argparse import Namespace
+    >>> block = b'12m bob /a/f\\n4.0K alice /b/g\\nshort line'
+    >>> parse_block(Namespace(path=None, user=None), block, 'utf-8', 'strict')
+    (1, ('/a/f', '/b/g'), [12582912.0, 4096.0], ('bob', 'alice'))
+    >>> parse_block(Namespace(path='/a', user=None), block, 'utf-8', 'strict')
+    (1, ('/a/f',), [12582912.0], ('bob',))
+    >>> parse_block(Namespace(path=None, user='alice'), block, 'utf-8', 'strict')
+    (1, ('/b/g',), [4096.0], ('alice',))
+    >>> parse_block(Namespace(path='/b', user='bob'), block, 'utf-8', 'strict')
+    (1, (), (), ())
+
+    '''
+    lines = block.decode(encoding, errors).split('\n')
+    # skip lines which cannot be parsed
+    rows = [fields for fields in map(str.split, lines) if len(fields) >= 3]
+    num_skipped_lines = len(lines) - len(rows)
+    if args.path:
+        path_prefix = args.path
+        rows = [fields for fields in rows if fields[2].startswith(path_prefix)]
+    if args.user:
+        user_name = args.user
+        rows = [fields for fields in rows if fields[1] == user_name]
+    if not rows:
+        return num_skipped_lines, (), (), ()
+    size_strs, user_names, paths = islice(zip(*rows), 3)
+    try:
+        sizes = list(map(size_in_bytes, size_strs))
+    except ValueError:
+        # find the first bad size in the block, to report it
+        for size in size_strs:
+            try:
+                size_in_bytes(size)
+            except ValueError:
+                exit("Bad file size in input: '{}'".format(size))
+    return num_skipped_lines, paths, sizes, user_names
+
+
+def parallel_map(function, items, jobs):
+    '''Generate function(item) for each of items, in order, computed by jobs
+    worker processes.
+
+    Unlike ProcessPoolExecutor.map, at most 2 * jobs items are submitted
+    ahead of the results being used, so the whole input is never held in
+    memory at once. Exceptions raised by function, including the SystemExit of a bad
+    input line, are raised again here.
+    '''
+    with ProcessPoolExecutor(jobs) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
 def process_input(args):
-    '''Read the input file from stdin, build file_path_tree
-    and user usage summary
+    '''Read the input file from stdin and build file_path_tree.
+
+    The user usage summary is not computed here, see
+    FilePathTree.user_totals.
+
+    If args.jobs is more than one then the input blocks are parsed in that
+    many worker processes, while this process builds the tree.
     '''
     file_path_tree = FilePathTree()
-    user_usage = {} 
     num_skipped_lines = 0
 
-    for line in sys.stdin:
-        fields = line.split()
-        # skip lines which cannot be parsed
-        if len(fields) >= 3:
-            size, user_name, path = fields[:3]
-            # check if we should consider this file path
-            if consider_file(args, user_name, path):
-                this_bytes = size_in_bytes(size)
-                if user_name not in user_usage:
-                    user_usage[user_name] = User(user_name, this_bytes, 1)
-                else:
-                    user_usage[user_name].file_size += this_bytes
-                    user_usage[user_name].count += 1 
-                file_path_tree.insert(path, this_bytes, user_name)
-        else:
-            num_skipped_lines += 1 
+    # Decode the input in the same way as sys.stdin would
+    parse = partial(parse_block, args, encoding=sys.stdin.encoding,
+        errors=sys.stdin.errors)
+    blocks = input_blocks(sys.stdin.fileno())
+    if args.jobs > 1:
+        parsed_blocks = parallel_map(parse, blocks, args.jobs)
+    else:
+        parsed_blocks = map(parse, blocks)
+    # The tree is built from a very large number of small container objects,
+    # none of which form reference cycles. Left enabled, the cyclic garbage
+    # collector keeps traversing the growing tree, more so with whole blocks
+    # of parsed lines alive at once, and that can take as long as building
+    # the tree itself.
+    gc.disable()
+    try:
+        for num_skipped, paths, sizes, user_names in parsed_blocks:
+            num_skipped_lines += num_skipped
+            # the same few user names are repeated on most lines, and are
+            # used as dictionary keys in the tree
+            file_path_tree.insert_bulk(paths, sizes, map(sys.intern, user_names))
+        file_path_tree.accumulate()
+    finally:
+        gc.enable()
 
     if num_skipped_lines > 0:
         print("Skipped {} lines in input.".format(num_skipped_lines))
 
-    return user_usage, file_path_tree
+    return file_path_tree
 
 
 def show_user_summary(total_count, total_size_usage, user_usage, precision):
@@ -382,9 +916,10 @@ def show_user_summary(total_count, total_size_usage, user_usage, precision):
 
 def main():
     args = parse_args()
-    user_usage, file_path_tree = process_input(args)
-    total_size_usage = sum([user_stats.size() for user, user_stats in user_usage.items()]) 
-    total_count = sum([user_stats.count for user, user_stats in user_usage.items()]) 
+    file_path_tree = process_input(args)
+    user_usage = file_path_tree.user_totals()
+    total_size_usage = sum(user_stats.size() for user_stats in user_usage.values())
+    total_count = sum(user_stats.count for user_stats in user_usage.values())
 
     if total_count > 0:
         if args.showusers:
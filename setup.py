@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from distutils.core import setup
+from setuptools import setup
 
 LONG_DESCRIPTION = '''Explore file usage in a top-down manner'''
 
@@ -19,4 +19,5 @@ setup(
     description=('Explore file usage in a top-down manner'),
     long_description=(LONG_DESCRIPTION),
     install_requires=["termcolor==1.1.0"],
+    python_requires='>=3.7',
 )